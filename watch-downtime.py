@@ -19,22 +19,68 @@
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
+import asyncio
 import datetime
+import errno
+import fcntl
 import logging
-import matplotlib.animation as ani
-import matplotlib.figure as fig
-import matplotlib.pyplot as plt
-import matplotlib.axes as axes
-import numpy as np
+import logging.handlers
 import os
-import psutil
+import queue
+import re
 import signal
+import socket
+import stat
+import struct
 import subprocess
 import sys
-from collections import deque
+import threading
+import time
 from pathlib import Path
 from time import sleep
-from typing import NamedTuple, List, Any
+from typing import NamedTuple, List, Optional, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import matplotlib.axes as axes
+    import matplotlib.figure as fig
+    import numpy as np
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+ICMP_ERRORS = {  # Error replies which quote the request that caused them
+    3: "Destination unreachable",
+    11: "Time to live exceeded"}
+ICMP_HEADER = struct.Struct("!BBHHH")  # Type, code, checksum, identifier, sequence
+ICMPV6_ECHO_REPLY = 129
+ICMPV6_ECHO_REQUEST = 128
+ICMPV6_ERRORS = {  # As ICMP_ERRORS, but the quoted IPv6 header is always 40 bytes (we send no extension headers)
+    1: "Destination unreachable",
+    3: "Time exceeded"}
+IPV6_HEADER_SIZE = 40
+# The ping command's timeout (in seconds) option. -t is the TTL on OpenBSD and the TOS on NetBSD, where -w is the timeout
+if sys.platform == 'darwin' or sys.platform.startswith('freebsd'):
+    PING_TIMEOUT_OPTION = '-t'
+elif sys.platform.startswith(('openbsd', 'netbsd')):
+    PING_TIMEOUT_OPTION = '-w'
+else:
+    PING_TIMEOUT_OPTION = '-W'
+PING_TIME_RE = re.compile(rb"time=([\d.]+)\s*ms")  # The latency in the output of the ping command
+SECONDS_PER_DAY = 60 * 60 * 24
+TIME_SPAN_RE = re.compile(r'(\d+(?:\.\d*)?|\.\d+)([smhdw]?)')  # A number of seconds, with an optional unit suffix
+TIME_UNITS = {  # Conversion factors
+    's': 1,
+    'm': 60,
+    'h': 60 * 60,
+    'd': SECONDS_PER_DAY,
+    'w': SECONDS_PER_DAY * 7}
+LOG_FORMAT = '%(asctime)s|%(process)+7s|%(levelname)-8s|%(message)s'  # 8 == len('CRITICAL'), the longest level name
+LOG_DATE_FORMAT = '%Y-%m-%d %H:%M:%S%z'
+LOG_BUFFER_CAPACITY = 64  # Log records buffered before writing to the logfile
+# Locked by the running instance. In the home directory, so instances started from the desktop, cron, ssh, etc. all
+# find the same file (XDG_RUNTIME_DIR is not set in all of them), no other user can create it first, and no /tmp
+# cleaner can delete it from under a long-running instance
+PID_FILE = Path.home() / '.cache' / 'watch-downtime.pid'
+STOP_TIMEOUT = 10  # Seconds to wait for a running instance to exit after --stop
 
 
 def set_log_level(level_name: str) -> int:
@@ -48,36 +94,31 @@ def set_log_level(level_name: str) -> int:
 def parse_time(value: str) -> int:
     """Parses a time string with a suffix to convert it to seconds.
     If no suffix exists, assume seconds.
-    Supported suffixes: s for seconds, m for minutes, h for hours, d for days.
+    Supported suffixes: s for seconds, m for minutes, h for hours, d for days, w for weeks.
+    The number may be fractional (e.g. '1.5h'), the result is truncated to whole seconds.
 
     Args:
         value (str): The value to parse
 
     Raises:
-        ValueError: Raised if the value is invalid
+        ValueError: Raised if the value is invalid, or less than a second
 
     Returns:
         int: The number of seconds represented by the given value
     """
-    if value[-1].isdigit():  # Check if there's no suffix and assume seconds
-        return int(value)
-    else:
-        units = {  # Conversion factors
-            's': 1,
-            'm': 60,
-            'h': 60 * 60,
-            'd': 60 * 60 * 24,
-            'w': 60 * 60 * 24 * 7}
-        number = int(value[:-1])  # The numeric part
-        unit = value[-1]  # The suffix
-        if unit in units:
-            return number * units[unit]
-        else:
-            raise ValueError(f"Invalid time unit '{unit}' in '{value}'. Use 's', 'm', 'h', 'd', or 'w'.")
+    match = TIME_SPAN_RE.fullmatch(value)
+    if match is None:
+        raise ValueError(f"Invalid time span '{value}'. Use a number with an optional 's', 'm', 'h', 'd', or 'w' suffix.")
+    number, unit = match.groups()
+    seconds = int(float(number) * TIME_UNITS.get(unit, 1))  # No suffix means seconds
+    if seconds < 1:
+        raise ValueError(f"Invalid time span '{value}'. It must be at least 1 second.")
+    return seconds
 
 
 def writable_file(filepath: str) -> Path:
-    """Check if the given path refers to a writeable file, or if it does not exist, try to create it as writeable.
+    """Check if the given path refers to a writeable file, or if it does not exist, that it can be created.
+    The file is not created here (the log handler creates it), so argument parsing has no side effects.
 
     Args:
         path (str): The path to the intended file, either relative or absolute
@@ -86,36 +127,81 @@ def writable_file(filepath: str) -> Path:
         argparse.ArgumentTypeError: If the path is invalid (message contains reason)
 
     Returns:
-        str: The string containing the absolute path
+        Path: The absolute path
     """
-    path = Path(filepath)
-    try:
-        if path.exists():  # If the file exists, try to open it in append mode to check write-ability
-            if not path.is_file():
-                raise argparse.ArgumentTypeError(f"Path is not a file: {path.absolute()}")
-            with path.open('a'):
-                pass
-        else:  # If the file does not exist, try creating it (also checks directory write-ability indirectly)
-            path.touch()
-        return path.absolute()
-    except PermissionError as e:
-        raise argparse.ArgumentTypeError(f"Insufficient permissions: {path.absolute()} ({str(e)})")
-    except IOError as e:
-        raise argparse.ArgumentTypeError(f"Unable to access: {path.absolute()} ({str(e)})")
+    path = Path(filepath).absolute()
+    if path.exists():
+        if not path.is_file():
+            raise argparse.ArgumentTypeError(f"Path is not a file: {path}")
+        if not os.access(path, os.W_OK):
+            raise argparse.ArgumentTypeError(f"Insufficient permissions: {path}")
+    elif not path.parent.is_dir():
+        raise argparse.ArgumentTypeError(f"Unable to access: {path} (no such directory: {path.parent})")
+    elif not os.access(path.parent, os.W_OK):
+        raise argparse.ArgumentTypeError(f"Insufficient permissions: {path} (directory is not writeable)")
+    return path
 
 
 def seconds_to_hms(seconds: int) -> str:
-    """Convert seconds to a human-readable format of hours, minutes, and seconds"""
-    time = []
+    """Convert seconds to a human-readable format of hours, minutes, and seconds (e.g. '2m 5s'),
+    omitting any zero parts (but 0 is '0s')"""
     hours, remainder = divmod(seconds, 3600)
     minutes, seconds = divmod(remainder, 60)
-    if hours > 0:
-        time.append(str(hours) + "h")
-    if minutes > 0:
-        time.append(str(minutes) + "m")
-    if seconds > 0:
-        time.append(str(seconds) + "s")
-    return " ".join(time)
+    if not hours:  # The common case, formatted directly
+        if not minutes:
+            return f"{seconds}s"
+        return f"{minutes}m {seconds}s" if seconds else f"{minutes}m"
+    hms = f"{hours}h"
+    if minutes:
+        hms += f" {minutes}m"
+    if seconds:
+        hms += f" {seconds}s"
+    return hms
+
+
+def sample_clock() -> float:
+    """Return the time in seconds on a clock that never goes backwards. Where available this is
+    CLOCK_BOOTTIME which, unlike time.monotonic() on Linux, keeps counting while the machine is suspended.
+    """
+    if hasattr(time, 'CLOCK_BOOTTIME'):
+        return time.clock_gettime(time.CLOCK_BOOTTIME)
+    return time.monotonic()
+
+
+def icmp_checksum(data: bytes) -> int:
+    """Compute the 16-bit one's complement checksum of the given data (RFC 1071)"""
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)  # Fold the carries back in (twice covers every case)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+def mask_spans(mask: "np.ndarray") -> "np.ndarray":
+    """Find the runs of True values in a boolean mask
+
+    Args:
+        mask (np.ndarray): The boolean mask, padded with a False value at each end
+
+    Returns:
+        np.ndarray: An (n, 2) array of [start, stop) index pairs (into the unpadded mask), one row per run
+    """
+    edges = np.flatnonzero(np.diff(mask.view(np.int8)))
+    return edges.reshape(-1, 2)
+
+
+def import_plotting():
+    """Import matplotlib and numpy (as module globals), which are slow to import and only needed for plotting"""
+    global dateutil, mcoll, mcolors, mdates, fig, plt, axes, np
+    import dateutil.tz  # A dependency of matplotlib
+    import matplotlib.collections as mcoll
+    import matplotlib.colors as mcolors
+    import matplotlib.dates as mdates
+    import matplotlib.figure as fig
+    import matplotlib.pyplot as plt
+    import matplotlib.axes as axes
+    import numpy as np
 
 
 def parse_args() -> argparse.Namespace:
@@ -181,7 +267,7 @@ will NOT be saved.
             "--plot",
             metavar="<window>",
             nargs="?",
-            help="""Optional graph window in seconds, or use a suffix (e.g. '2d'):
+            help="""Optional graph window in seconds, or use a suffix (e.g. '1.5h'):
     's': Seconds
     'm': Minutes
     'h': Hours
@@ -228,51 +314,296 @@ be used (if set)
     return result
 
 
+class PingResult(NamedTuple):
+    """The outcome of a single ping"""
+    latency: float  # Milliseconds (0 if the ping failed)
+    error: Optional[str]  # The reason the ping failed, or None if it succeeded
+
+
 class Pinger:
     """Base class for pinging a remote host, capturing latency, and logging
     downtime, warnings, or all results (based upon the logging level)
     """
 
-    def __init__(self, target_host: str, threshold: float):
+    TIMEOUT = 10  # Maximum seconds to wait for a reply (the default of the ping command)
+    RESOLVE_TTL = 15 * 60  # Seconds before the host's address is resolved again
+    PAYLOAD = b"watch-downtime"
+
+    def __init__(self, target_host: str, threshold: float, interval: int):
         self.target_host = target_host
         self.threshold = threshold
+        self.interval = interval
+        self.timeout = min(interval, self.TIMEOUT)
+        self.target_ip: Optional[str] = None  # Resolved on the first ping, so DNS failures are logged as downtime
+        self.target_address: Tuple = ()  # The socket address of target_ip (with the scope of an IPv6 link-local address)
+        self.resolved_at = 0.0
+        self.host_label = target_host  # The host as it appears in the log, including its address once resolved
+        self.ping_args: Tuple[str, ...] = ()  # The ping command's argv, rebuilt only when the address changes
+        self.identifier = os.getpid() & 0xFFFF
+        self.sequence = 0
+        self.family = socket.AF_INET  # Of the socket, reopened for IPv6 if that is what the host resolves to
+        self.sock = self.open_socket(self.family)
+
+    @staticmethod
+    def open_socket(family: int) -> Optional[socket.socket]:
+        """Open an ICMP socket, preferring an unprivileged "ping" socket (SOCK_DGRAM)
+        over a raw socket (SOCK_RAW, requires root or CAP_NET_RAW)
 
-    def ping_host(self) -> float:
-        """Ping the host and return the latency, logging messages at the same time.
+        Args:
+            family (int): The address family, socket.AF_INET (ICMP) or socket.AF_INET6 (ICMPv6)
+
+        Returns:
+            Optional[socket.socket]: The socket, or None if neither kind is permitted or supported
+                    (in which case the ping command is used instead)
+        """
+        protocol = socket.IPPROTO_ICMPV6 if family == socket.AF_INET6 else socket.IPPROTO_ICMP
+        for sock_type in (socket.SOCK_DGRAM, socket.SOCK_RAW):
+            try:
+                sock = socket.socket(family, sock_type, protocol)
+                sock.setblocking(False)
+                return sock
+            except OSError:  # e.g. PermissionError, or EPROTONOSUPPORT where there are no ping sockets (the BSDs)
+                pass
+        return None
+
+    async def monitor(self, stopped: asyncio.Event):
+        """Ping the host every interval until stopped is set, passing each result to record().
+        The ping runs concurrently with the wait for the next interval, and pings are scheduled at fixed
+        deadlines (start + k * interval), so neither the ping's latency nor the loop's overhead delays the schedule.
 
         Args:
-            target_host (str): The hostname/IP address to check
-            threshold (float): The threshold latency (ms) at which to report a warning
+            stopped (asyncio.Event): Set to stop monitoring
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        while True:
+            ping = asyncio.create_task(self.record_ping())
+            deadline += self.interval
+            try:
+                await asyncio.wait_for(stopped.wait(), max(deadline - loop.time(), 0))
+                ping.cancel()
+                await asyncio.gather(ping, return_exceptions=True)  # Let it clean up (e.g. kill a ping command)
+                return
+            except asyncio.TimeoutError:
+                await ping  # The ping times out within the interval, so this rarely waits
+            if loop.time() > deadline + self.interval:  # Fell more than an interval behind (e.g. a slow ping command)
+                deadline = loop.time()  # so skip the missed pings rather than sending them in a burst
+
+    async def record_ping(self):
+        """Ping the host and record the result"""
+        when = sample_clock()
+        self.record(when, await self.ping_host())
+
+    def record(self, when: float, result: PingResult):
+        """Handle the result of a ping made by monitor() (ping_host has already logged it)
+
+        Args:
+            when (float): The sample_clock() time of the ping
+            result (PingResult): The result of the ping
+        """
+        pass
+
+    async def ping_host(self) -> PingResult:
+        """Ping the host and return the latency, logging messages at the same time.
 
         Returns:
-            float: The milliseconds of latency from the ping
-                    >0 == Success
-                    0 == Failed
+            PingResult: The milliseconds of latency from the ping, and the reason
+                    for the failure (None if the host is up)
         """
         try:
-            result = subprocess.run(
-                ["ping", "-c", "1", self.target_host],
-                text=True,  # Equivalent to universal_newlines=True in Python 3.7+
-                capture_output=True  # Captures both stdout and stderr
-            )
-            if result.returncode != 0:
-                msg = result.stderr.strip()
-                if not msg:
-                    lines: List[str] = result.stdout.strip().split("\n")
-                    msg = lines[-1]
-                if not msg:
-                    msg = "Timed out"
-                logger.error(f"Host: {self.target_host}: DOWN ({msg})")
-                return 0
-            result = float(result.stdout.split("time=")[1].split(" ms")[0])  # Extract the time (ms)
+            await self.resolve_host()
+            if self.sock is None:
+                result = await self.ping_command()
+            else:
+                result = await self.ping_socket()
             if result > self.threshold:
-                logger.warning(f"Host: {self.target_host}: {result}ms")
+                logger.warning(f"Host: {self.host_label}: {result}ms")
             else:
-                logger.debug(f"Host: {self.target_host}: {result}ms")
-            return result
+                logger.debug(f"Host: {self.host_label}: {result}ms")
+            return PingResult(result, None)
+        except asyncio.CancelledError:  # An Exception before Python 3.8, but monitoring has stopped, not the host
+            raise
         except Exception as e:
-            logger.error(f"Host: {self.target_host}: DOWN ({str(e)})")
-            return 0
+            logger.error(f"Host: {self.host_label}: DOWN ({str(e)})")
+            return PingResult(0.0, str(e))
+
+    async def resolve_host(self):
+        """Resolve the target host to an IP address, caching the result for RESOLVE_TTL seconds.
+        If a refresh fails, the previously resolved address is kept.
+
+        Raises:
+            socket.gaierror: If the host has never been resolved and cannot be
+        """
+        now = time.monotonic()
+        if self.target_ip is not None and now - self.resolved_at < self.RESOLVE_TTL:
+            return
+        try:
+            # Either family, in the system's order of preference (which puts IPv6 last if it has no route)
+            addresses = await asyncio.get_running_loop().getaddrinfo(self.target_host, None, type=socket.SOCK_RAW)
+            self.resolved_at = now
+            if addresses[0][4][0] != self.target_ip:
+                family, _, _, _, self.target_address = addresses[0]
+                self.target_ip = self.target_address[0]
+                if family != self.family:
+                    if self.sock is not None:
+                        self.sock.close()
+                    self.family = family
+                    self.sock = self.open_socket(family)
+                self.host_label = self.target_host if self.target_ip == self.target_host else f"{self.target_host} ({self.target_ip})"
+                # -n skips the reverse DNS lookup
+                self.ping_args = ("ping", "-c", "1", "-n", PING_TIMEOUT_OPTION, str(self.timeout), self.target_ip)
+                logger.debug(f"Host: {self.host_label}: Resolved")
+        except socket.gaierror as e:
+            if self.target_ip is None:
+                raise
+            logger.debug(f"Host: {self.host_label}: Unable to refresh address ({str(e)})")
+
+    async def ping_socket(self) -> float:
+        """Send a single ICMP echo request over the ICMP socket and wait for the reply
+
+        Raises:
+            TimeoutError: If no reply arrives within the timeout
+            RuntimeError: If an ICMP error is received for the request
+
+        Returns:
+            float: The milliseconds of latency from the ping
+        """
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        if self.family == socket.AF_INET6:  # The kernel computes ICMPv6 checksums (they cover the IPv6 addresses)
+            packet = ICMP_HEADER.pack(ICMPV6_ECHO_REQUEST, 0, 0, self.identifier, self.sequence) + self.PAYLOAD
+        else:
+            header = ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, 0, self.identifier, self.sequence)
+            checksum = icmp_checksum(header + self.PAYLOAD)
+            packet = ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, checksum, self.identifier, self.sequence) + self.PAYLOAD
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter_ns()
+        deadline = start + self.timeout * 1_000_000_000
+        self.sock.sendto(packet, self.target_address)
+        identifier = self.identifier
+        if self.sock.type == socket.SOCK_DGRAM and sys.platform.startswith('linux'):
+            identifier = self.sock.getsockname()[1]  # Linux ping sockets replace the identifier with their "port"
+        while True:
+            remaining = deadline - time.perf_counter_ns()
+            try:
+                if remaining <= 0:
+                    raise asyncio.TimeoutError
+                reply = await asyncio.wait_for(loop.sock_recv(self.sock, 1024), remaining / 1_000_000_000)
+            except asyncio.TimeoutError:
+                raise TimeoutError("Timed out")
+            end = time.perf_counter_ns()
+            if self.is_reply(reply, identifier):
+                return round((end - start) / 1_000_000, 3)
+
+    def is_reply(self, packet: bytes, identifier: int) -> bool:
+        """Check if a received packet is the reply to the current request
+
+        Args:
+            packet (bytes): The packet received from the ICMP socket
+            identifier (int): The identifier of the current request, as sent by the kernel
+
+        Raises:
+            RuntimeError: If the packet is an ICMP error caused by the current request
+
+        Returns:
+            bool: True if the packet is the echo reply, False if it should be ignored
+        """
+        if self.family == socket.AF_INET6:  # IPv6 sockets never receive the IP header
+            echo_request, echo_reply, errors = ICMPV6_ECHO_REQUEST, ICMPV6_ECHO_REPLY, ICMPV6_ERRORS
+        else:
+            echo_request, echo_reply, errors = ICMP_ECHO_REQUEST, ICMP_ECHO_REPLY, ICMP_ERRORS
+            if packet[0] >> 4 == 4:  # Raw sockets (and ping sockets on macOS) receive the IPv4 header, so skip it
+                packet = packet[(packet[0] & 0x0F) * 4:]
+        icmp_type, code, _, reply_identifier, sequence = ICMP_HEADER.unpack_from(packet)
+        if icmp_type in errors:
+            # The error quotes the IP header and the first 8 bytes of the request which caused it
+            request = packet[ICMP_HEADER.size:]
+            request = request[IPV6_HEADER_SIZE if self.family == socket.AF_INET6 else (request[0] & 0x0F) * 4:]
+            if len(request) >= ICMP_HEADER.size:
+                request_type, _, _, request_identifier, sequence = ICMP_HEADER.unpack_from(request)
+                if request_type == echo_request and request_identifier == identifier and sequence == self.sequence:
+                    raise RuntimeError(f"{errors[icmp_type]} (code {code})")
+            return False
+        # Only Linux ping sockets are limited to their own replies, other sockets receive every ICMP packet
+        return icmp_type == echo_reply and reply_identifier == identifier and sequence == self.sequence
+
+    async def ping_command(self) -> float:
+        """Ping the host using the ping command (used if ICMP sockets are not permitted)
+
+        Raises:
+            RuntimeError: If the ping fails (message contains the reason)
+
+        Returns:
+            float: The milliseconds of latency from the ping
+        """
+        proc = await asyncio.create_subprocess_exec(
+            *self.ping_args,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT  # A single pipe to read, errors are the last line of the output
+        )
+        try:
+            stdout, _ = await asyncio.wait_for(proc.communicate(), self.timeout + 1)
+        except asyncio.TimeoutError:
+            raise TimeoutError("Timed out")
+        finally:
+            if proc.returncode is None:  # Timed out or cancelled, don't leave the ping behind
+                proc.kill()
+                await proc.wait()
+        match = PING_TIME_RE.search(stdout) if proc.returncode == 0 else None
+        if match is None:
+            lines: List[str] = stdout.decode(errors='replace').strip().split("\n")
+            msg = lines[-1]
+            if not msg:
+                msg = "Timed out"
+            raise RuntimeError(msg)
+        return float(match.group(1))
+
+
+class RingBuffer:
+    """A fixed number of (time, latency) samples, the oldest being overwritten once it is full.
+    Each sample is stored twice (at i and i + capacity) so the samples are always a contiguous, chronological view.
+    """
+
+    __slots__ = ('capacity', 'head', 'count', '_times', '_latencies')
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.head = 0  # Index of the next sample to be written
+        self.count = 0  # Number of samples in the buffer
+        self._times = np.empty(capacity * 2, dtype=np.float64)  # In matplotlib date units (days)
+        self._latencies = np.empty(capacity * 2, dtype=np.float32)
+
+    def __len__(self) -> int:
+        return self.count
+
+    @property
+    def times(self) -> "np.ndarray":
+        """The times of the samples in chronological order (a view, not a copy)"""
+        return self._view(self._times)
+
+    @property
+    def latencies(self) -> "np.ndarray":
+        """The latencies of the samples in chronological order (a view, not a copy)"""
+        return self._view(self._latencies)
+
+    def _view(self, buffer: "np.ndarray") -> "np.ndarray":
+        start = (self.head - self.count) % self.capacity
+        return buffer[start:start + self.count]
+
+    def extend(self, timestamps: "np.ndarray", latencies: "np.ndarray"):
+        """Append a batch of samples, overwriting the oldest samples once the buffer is full
+
+        Args:
+            timestamps (np.ndarray): The times of the samples, in matplotlib date units
+            latencies (np.ndarray): The latencies of the samples
+        """
+        timestamps, latencies = timestamps[-self.capacity:], latencies[-self.capacity:]  # Only the newest fit
+        index = (self.head + np.arange(len(timestamps))) % self.capacity
+        mirror = index + self.capacity
+        self._times[index] = self._times[mirror] = timestamps
+        self._latencies[index] = self._latencies[mirror] = latencies
+        self.head = (self.head + len(timestamps)) % self.capacity
+        self.count = min(self.count + len(timestamps), self.capacity)
 
 
 class Plotter(Pinger):
@@ -280,13 +611,30 @@ class Plotter(Pinger):
 
     MAX_POINTS = 1800
     THRESHOLD_PLOT_BUFFER = 10  # ms
+    SPAN_COLORS = ('red', 'orange')  # Downtime, warning
+    LIGHT_COLORS = ('black', 'white', 'white')  # Text, figure background, axes background
+    DARK_COLORS = ('white', '#303030', '#505050')
+    REFRESH_INTERVAL = 250  # Milliseconds between checks for new samples
+    CLOCK_RESYNC = 1.0  # Seconds the wall clock may get ahead of sample_clock() (e.g. during a suspend) before re-anchoring
+    XLIM_HEADROOM = 0.05  # Fraction of the window left empty ahead of the latest sample when the x-axis steps forward
 
     def __init__(self, target_host: str, threshold: float, interval: int, window: int, dark_mode: bool):
-        super().__init__(target_host=target_host, threshold=threshold)
+        super().__init__(target_host=target_host, threshold=threshold, interval=interval)
+        import_plotting()
 
-        self.interval = interval
         self.window = window
         self.interrupted = False
+        # The pings run on a separate (sampler) thread with its own event loop, so the GUI never waits on the
+        # network. Samples are handed to the GUI thread through a queue
+        self.loop = asyncio.new_event_loop()
+        # Created by sample(), on self.loop (before Python 3.10 an Event binds to the loop current when it is created)
+        self.stopped: Optional[asyncio.Event] = None
+        self.samples: queue.SimpleQueue = queue.SimpleQueue()
+        # Sample times are taken from sample_clock() (so they never go backwards with the system clock) and
+        # anchored to the wall clock here, and again by record() if the wall clock gets ahead of it. The anchor is
+        # in UTC, which (unlike local time) never falls back, and the axis shows the times in local time
+        self.epoch = mdates.date2num(datetime.datetime.now(datetime.timezone.utc))
+        self.epoch_clock = sample_clock()
 
         if self.window < interval:
             self.window = interval * 2
@@ -299,26 +647,41 @@ class Plotter(Pinger):
             self.window = window_points * interval
             logger.warning(f"Plotting window is too large, reducing to: {window_points} points or {seconds_to_hms(self.window)} at {seconds_to_hms(self.interval)} intervals (was {seconds_to_hms(window)})")
 
-        # Deques to store the time and latency data
-        self.times = deque(maxlen=window_points)
-        self.latencies = deque(maxlen=window_points)
-        self.warnings = deque(maxlen=window_points)
-        self.downtimes = deque(maxlen=window_points)
-        self.max_latency = self.threshold
+        self.buffer = RingBuffer(window_points)
+        self.peak_latency = 0.0  # The highest latency in the buffer
+        self.max_latency = self.threshold + self.THRESHOLD_PLOT_BUFFER  # The top of the y-axis
+        self.xlim = (0.0, 0.0)  # The current x-axis limits (in matplotlib date units)
+        # Step the x-axis forward by more than a sample at a time, so most frames can be blitted
+        self.xlim_headroom = max(self.interval, self.window * self.XLIM_HEADROOM) / SECONDS_PER_DAY
+        self.background = None  # The figure without the line and spans, cached for blitting
+        self.stale = False  # True if samples arrived while the window was hidden, and have not been drawn yet
+        self.mask = np.zeros(window_points + 2, dtype=bool)  # Scratch space for the span masks
 
         self.fig: fig.Figure
         self.ax: axes.Axes
         self.fig, self.ax = plt.subplots()
+        self.canvas = self.fig.canvas  # The window's canvas (savefig() may draw the figure on another)
 
-        self.fig.patch.set_facecolor('#303030' if dark_mode else 'white')
-        self.ax.set_facecolor('#505050' if dark_mode else 'white')
+        text_color, figure_color, axes_color = self.DARK_COLORS if dark_mode else self.LIGHT_COLORS
+        self.fig.patch.set_facecolor(figure_color)
+        self.ax.set_facecolor(axes_color)
 
+        self.span_colors = mcolors.to_rgba_array(self.SPAN_COLORS)
         self.line, = self.ax.plot([], [], lw=2)
-        self.ax.set_ylim(0, self.threshold + self.THRESHOLD_PLOT_BUFFER)
-        self.ax.set_xlabel('Time', color='white' if dark_mode else 'black')
-        self.ax.set_ylabel('Ping Latency (ms)', color='white' if dark_mode else 'black')
-        self.ax.tick_params(axis='x', colors='white' if dark_mode else 'black')
-        self.ax.tick_params(axis='y', colors='white' if dark_mode else 'black')
+        # The times are stored as plain floats (in UTC), so mark the axis as dates, labelled in local time
+        self.ax.xaxis_date(tz=dateutil.tz.tzlocal())
+        # A persistent collection for the downtime and warning spans, whose vertices (and colors) are replaced
+        # each frame. They span the full height of the axes (x in data coordinates, y in axes coordinates)
+        self.spans = mcoll.PolyCollection([], transform=self.ax.get_xaxis_transform())
+        self.ax.add_collection(self.spans, autolim=False)
+        # The line and spans are drawn over the cached background by redraw(), rather than by the figure
+        self.line.set_animated(True)
+        self.spans.set_animated(True)
+        self.fig.canvas.mpl_connect('draw_event', self.on_draw)
+        self.ax.set_ylim(0, self.max_latency)
+        self.ax.set_xlabel('Time', color=text_color)
+        self.ax.set_ylabel('Ping Latency (ms)', color=text_color)
+        self.ax.tick_params(axis='both', colors=text_color)
 
         plt.xticks(rotation=90)
         plt.subplots_adjust(left=0.1, right=0.99, top=0.99, bottom=0.2)
@@ -328,41 +691,180 @@ class Plotter(Pinger):
         except Exception as e:
             logger.exception("Unable to set window title")
 
-    def update_plot(self, frame: Any):
-        """Update the plot with new data"""
-        self.times.append(datetime.datetime.now())
-        result = self.ping_host()
-        self.latencies.append(result)
+    def record(self, when: float, result: PingResult):
+        """Queue the result of a ping for the plot (called on the sampler thread)"""
+        # Where sample_clock() stops during a suspend, move the anchor forward so the times stay true to the wall
+        # clock. It is never moved back, so the samples stay in order if the wall clock is set back
+        drift = mdates.date2num(datetime.datetime.now(datetime.timezone.utc)) - (self.epoch + (sample_clock() - self.epoch_clock) / SECONDS_PER_DAY)
+        if drift > self.CLOCK_RESYNC / SECONDS_PER_DAY:
+            self.epoch += drift
+        timestamp = self.epoch + (when - self.epoch_clock) / SECONDS_PER_DAY  # In matplotlib date units
+        # A failed ping is stored as NaN, so it can't be mistaken for a latency (and leaves a gap in the line)
+        self.samples.put((timestamp, float('nan') if result.error is not None else result.latency))
+
+    def sample(self):
+        """Run the pings on the sampler thread until self.stopped is set"""
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGINT, signal.SIGTERM})  # Leave signals to the main thread
+        asyncio.set_event_loop(self.loop)
+        self.stopped = asyncio.Event()
+        self.loop.run_until_complete(self.monitor(self.stopped))
+
+    def stop_sampling(self):
+        """Set self.stopped (called on the sampler thread's event loop, via call_soon_threadsafe)"""
+        self.stopped.set()
+
+    def update_plot(self):
+        """Add any new samples to the plot and redraw it (called periodically by a timer on the GUI thread)"""
+        pending = self.samples.qsize()
+        if not pending and not self.stale:
+            return
+        if pending:
+            self.add_samples(pending)
+
+        if not self.is_visible():  # Keep collecting samples, but don't draw while the window is minimized
+            self.stale = True  # so they are drawn as soon as it is restored, not with the next sample
+            return
+        self.stale = False
+
+        if len(self.buffer) > 1:  # Don't plot unless we have at least 2 points
+            x = self.buffer.times
+            latencies = self.buffer.latencies
+            width = max(int(self.ax.bbox.width), 1)  # In pixels (0 when the window is shrunk to almost nothing)
+            if len(self.buffer) > 2 * width:  # More points than can be seen, so only draw each pixel's min and max
+                self.line.set_data(*self.downsample(x, latencies, width))
+            else:
+                self.line.set_data(x, latencies)
+            if x[-1] > self.xlim[1]:  # Changing the limits means redrawing everything, so only do so when needed
+                self.xlim = (x[0], x[-1] + self.xlim_headroom)
+                self.ax.set_xlim(self.xlim)
+                self.background = None
+            # Downtimes are when latency is NaN (a failed ping), warnings are when latency is greater than threshold
+            # The masks are written into the same scratch array (between its False padding) rather than allocated
+            mask = self.mask[:len(latencies) + 2]
+            mask[-1] = False
+            np.isnan(latencies, out=mask[1:-1])
+            downtimes = self.span_polygons(x, mask)
+            np.greater(latencies, self.threshold, out=mask[1:-1])
+            warnings = self.span_polygons(x, mask)
+            self.spans.set_verts(np.concatenate((downtimes, warnings)))
+            self.spans.set_facecolor(np.repeat(self.span_colors, [len(downtimes), len(warnings)], axis=0))
+            self.redraw()
+
+    def add_samples(self, pending: int):
+        """Move the pending samples from the queue to the ring buffer, and keep the y-axis fitted to them
 
-        if result + self.THRESHOLD_PLOT_BUFFER > self.max_latency:
-            self.max_latency = result + self.THRESHOLD_PLOT_BUFFER  # Leave a little space above the line
+        Args:
+            pending (int): The number of samples in the queue
+        """
+        timestamps, latencies = np.array([self.samples.get() for _ in range(pending)]).T
+        # Track the peak as samples come and go, only rescanning the buffer when the peak itself is overwritten
+        # (fmax skips the NaNs of failed pings)
+        buffer = self.buffer
+        overwritten = min(len(buffer) + len(latencies) - buffer.capacity, len(buffer))  # The oldest samples
+        rescan = overwritten > 0 and np.fmax.reduce(buffer.latencies[:overwritten], initial=0.0) >= self.peak_latency
+        buffer.extend(timestamps, latencies)
+        if rescan:
+            self.peak_latency = float(np.fmax.reduce(buffer.latencies, initial=0.0))
+        else:
+            self.peak_latency = float(np.fmax.reduce(buffer.latencies[-len(latencies):], initial=self.peak_latency))
+        max_latency = max(self.peak_latency, self.threshold) + self.THRESHOLD_PLOT_BUFFER  # A little space above the line
+        if max_latency != self.max_latency:
+            self.max_latency = max_latency
             self.ax.set_ylim(0, self.max_latency)
+            self.background = None
+
+    def redraw(self):
+        """Blit the line and spans over the cached background, or redraw the whole figure if the axes have changed"""
+        canvas = self.fig.canvas
+        if self.background is None:
+            canvas.draw_idle()  # on_draw() caches the new background
+            return
+        canvas.restore_region(self.background)
+        self.ax.draw_artist(self.spans)
+        self.ax.draw_artist(self.line)
+        canvas.blit(self.fig.bbox)
+
+    def on_draw(self, event):
+        """Cache the background and draw the line and spans over it whenever the whole figure is drawn
+        (including when it is saved, possibly on a vector canvas with its own renderer)"""
+        canvas = self.canvas
+        if event.canvas is canvas and canvas.supports_blit and not canvas.is_saving():
+            self.background = canvas.copy_from_bbox(self.fig.bbox)
+        self.spans.draw(event.renderer)
+        self.line.draw(event.renderer)
+
+    def is_visible(self) -> bool:
+        """Check if the plot window is showing, i.e. not minimized or hidden. Only the Qt and Tk
+        backends are queried, windows of other backends are assumed to be visible."""
+        window = getattr(self.fig.canvas.manager, 'window', None)
+        try:
+            if hasattr(window, 'isMinimized'):  # Qt
+                return window.isVisible() and not window.isMinimized()
+            if hasattr(window, 'wm_state'):  # Tk
+                return window.wm_state() in ('normal', 'zoomed')
+        except Exception:
+            pass  # The window may already be destroyed
+        return True
+
+    @staticmethod
+    def downsample(x: "np.ndarray", y: "np.ndarray", buckets: int) -> Tuple["np.ndarray", "np.ndarray"]:
+        """Reduce a line to the minimum and maximum of each of (about) the given number of buckets, in order,
+        which looks the same when each bucket is no wider than a pixel. A bucket with a NaN (a failed ping) keeps
+        it as both, so the gap in the line still shows.
 
-        if result == 0:
-            self.downtimes.append(True)  # Downtimes are when latency is 0
-        else:
-            self.downtimes.append(False)
+        Args:
+            x (np.ndarray): The x values
+            y (np.ndarray): The y values
+            buckets (int): The number of buckets
 
-        if result > self.threshold:
-            self.warnings.append(True)  # Warnings are when latency is greater than threshold
-        else:
-            self.warnings.append(False)
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The x and y values of the reduced line
+        """
+        size = -(-len(y) // buckets)  # Samples per bucket, rounded up
+        whole = (len(y) - 1) // size * size  # The remainder (the newest samples, at least one) is kept as is
+        grouped = y[:whole].reshape(-1, size)
+        starts = np.arange(0, whole, size)[:, np.newaxis]
+        extremes = np.sort(np.stack((grouped.argmin(axis=1), grouped.argmax(axis=1)), axis=1), axis=1) + starts
+        index = np.concatenate((extremes.ravel(), np.arange(whole, len(y))))
+        return x[index], y[index]
+
+    @staticmethod
+    def span_polygons(x: "np.ndarray", mask: "np.ndarray") -> "np.ndarray":
+        """Build one full-height rectangle per run of flagged samples. As with a 'pre' step,
+        each sample covers the interval leading up to it.
 
-        if len(self.latencies) > 1:  # Don't plot unless we have at least 2 points
-            self.line.set_data(self.times, self.latencies)
-            self.ax.set_xlim(self.times[0], self.times[-1])
-            self.ax.fill_between(self.times, 0, self.max_latency, where=self.downtimes, step='pre', color='red')
-            self.ax.fill_between(self.times, 0, self.max_latency, where=self.warnings, step='pre', color='orange')
+        Args:
+            x (np.ndarray): The sample times (in matplotlib date units)
+            mask (np.ndarray): The boolean mask of flagged samples, padded with a False value at each end
 
-        return self.line,
+        Returns:
+            np.ndarray: An (n, 4, 2) array of rectangle vertices, in (data x, axes y) coordinates
+        """
+        spans = mask_spans(mask)
+        x0 = x[np.maximum(spans[:, 0] - 1, 0)]
+        x1 = x[spans[:, 1] - 1]
+        xs = np.stack((x0, x1, x1, x0), axis=1)
+        ys = np.broadcast_to(np.array([0.0, 0.0, 1.0, 1.0]), xs.shape)
+        return np.stack((xs, ys), axis=2)
 
     def start_monitoring(self) -> bool:
         """Start monitoring the network"""
         logger.info(f"Plotting:   STARTED|Window: {seconds_to_hms(self.window)} at {seconds_to_hms(self.interval)} intervals ({self.window // self.interval} points)")
         signal.signal(signal.SIGINT, self.signal_handler)
         signal.signal(signal.SIGTERM, self.signal_handler)
-        _ = ani.FuncAnimation(self.fig, self.update_plot, interval=self.interval * 1000, blit=True, cache_frame_data=False)
+        if sys.version_info < (3, 8):  # Before ThreadedChildWatcher, ping commands need the child watcher on our loop
+            asyncio.get_child_watcher().attach_loop(self.loop)
+        sampler = threading.Thread(target=self.sample, name="sampler", daemon=True)
+        sampler.start()
+        # The timer also gives Python a regular chance to run the signal handlers while the GUI is idle
+        timer = self.fig.canvas.new_timer(interval=self.REFRESH_INTERVAL)
+        timer.add_callback(self.update_plot)
+        timer.start()
         plt.show()
+        timer.stop()
+        self.loop.call_soon_threadsafe(self.stop_sampling)  # Runs after sample() has created self.stopped
+        sampler.join()
+        self.loop.close()
         elapsed = seconds_to_hms(int((datetime.datetime.now()-start_time).total_seconds()))
         logger.info(f"Plotting:   STOPPED|Plotted for: {elapsed}")
         return self.interrupted
@@ -379,75 +881,120 @@ class Watcher(Pinger):
     """Class for watching the network without plotting"""
 
     def __init__(self, target_host: str, threshold: float, interval: int):
-        super().__init__(target_host=target_host, threshold=threshold)
-        self.interval = interval
+        super().__init__(target_host=target_host, threshold=threshold, interval=interval)
 
     def start_monitoring(self) -> bool:
         """Start monitoring the network"""
-        signal.signal(signal.SIGINT, self.signal_handler)
-        signal.signal(signal.SIGTERM, self.signal_handler)
+        return asyncio.run(self.watch())
+
+    async def watch(self) -> bool:
+        """Monitor the host until SIGINT or SIGTERM is received
+
+        Returns:
+            bool: True when stopped by a signal
+        """
+        loop = asyncio.get_running_loop()
+        stopped = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stopped.set)
         try:
-            while True:
-                self.ping_host()
-                sleep(self.interval)
-        except self.SignalInterrupt:
+            await self.monitor(stopped)
             return True
+        finally:
+            # Restore the default signal handlers (so a second signal during shutdown ends the process)
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(sig)
+                signal.signal(sig, signal.SIG_DFL)
 
-    class SignalInterrupt(Exception):
-        """Custom exception for signal interrupts"""
-        pass
 
-    def signal_handler(self, sig, frame):
-        # Restore the default signal handlers
-        signal.signal(signal.SIGINT, signal.SIG_DFL)
-        signal.signal(signal.SIGTERM, signal.SIG_DFL)
-        raise self.SignalInterrupt  # Raise the custom exception to break out of the monitoring loop
+def read_pid(fd: int) -> int:
+    """Read the PID recorded in the pidfile, giving an instance that has just locked it a moment to write it
+
+    Args:
+        fd (int): The open pidfile
 
+    Raises:
+        RuntimeError: If no PID is recorded
+
+    Returns:
+        int: The PID
+    """
+    deadline = time.monotonic() + 1
+    while True:
+        text = os.pread(fd, 32, 0).strip()
+        if text.isdigit():
+            return int(text)
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"No PID recorded in: {PID_FILE}")
+        sleep(0.1)
 
-def check_running(stop: bool) -> List[psutil.Process]:
-    """Check if running instances of this app exist, optionally attempting
-    to stop them, returning any remaining running processes
+
+def check_running(stop: bool) -> List[int]:
+    """Check if another instance of this app is running (it holds a lock on PID_FILE), optionally attempting
+    to stop it. Once no other instance is running, this instance takes the lock (which the OS releases when
+    it exits, however it exits) and records its PID in the file
 
     Args:
-        stop (bool): If True, attempt to stop the running processes
+        stop (bool): If True, attempt to stop the running instance
+
+    Raises:
+        OSError: If the pidfile cannot be created or opened
+        PermissionError: If the pidfile is not a regular file owned by this user
 
     Returns:
-        List[psutil.Process]: List of any remaining running processes
+        List[int]: The PID of the instance that is still running, if any
     """
-    current_pid = os.getpid()
-    running_instances: List[psutil.Process] = []
-    for proc in psutil.process_iter(['name', 'cmdline', 'username']):
+    global pid_file_fd
+    # Kept open (and locked) until this process exits. Never follow a symlink (or write to a file planted by another user)
+    PID_FILE.parent.mkdir(parents=True, exist_ok=True)
+    pid_file_fd = os.open(PID_FILE, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o644)
+    status = os.fstat(pid_file_fd)
+    if not stat.S_ISREG(status.st_mode) or status.st_uid != os.getuid():
+        raise PermissionError(errno.EACCES, "Not a regular file owned by this user", str(PID_FILE))
+    deadline = None
+    while True:
         try:
-            if proc.pid != current_pid and proc.info['name'].startswith('python') and script_name in " ".join(proc.info['cmdline']):
-                if stop:
-                    sys.stderr.write(f"Stopping: {proc.pid}")
-                    proc.terminate()
-                    sys.stderr.write(f" (STOPPED)\n")
-                    sleep(1)  # Give the process a chance to log the stop
-                else:
-                    running_instances.append(proc)
-        except (psutil.NoSuchProcess, psutil.ZombieProcess) as e:
-            sys.stderr.write(f" (IGNORED: {e.__class__.__name__})\n")
-        except Exception as e:  # psutil.AccessDenied:
-            sys.stderr.write(f" (FAILED: {e.__class__.__name__}: {proc.info['username']})\n")
-            running_instances.append(proc)
-    return running_instances
+            fcntl.flock(pid_file_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except BlockingIOError:
+            pid = read_pid(pid_file_fd)
+            if not stop:
+                return [pid]
+            if deadline is None:
+                sys.stderr.write(f"Stopping: {pid}")
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass  # Already exiting, so just wait for the lock
+                except PermissionError as e:
+                    sys.stderr.write(f" (FAILED: {e.__class__.__name__})\n")
+                    return [pid]
+                deadline = time.monotonic() + STOP_TIMEOUT
+            elif time.monotonic() > deadline:
+                sys.stderr.write(" (FAILED: Timed out)\n")
+                return [pid]
+            sleep(0.1)
+    if deadline is not None:
+        sys.stderr.write(" (STOPPED)\n")
+    # Overwrite in place with a fixed width, so a reader never sees the file empty or half written
+    os.pwrite(pid_file_fd, f"{os.getpid():>10}\n".encode(), 0)
+    return []
 
 
 def configure_logger(level: int, console: bool, logfile: Path) -> logging.Logger:
     """Configure the logger"""
     logger = logging.getLogger(os.path.basename(sys.argv[0]))
-    level_width = max(len(name) for name in logging._levelToName.values())
-    formatter = logging.Formatter(fmt=f'%(asctime)s|%(process)+7s|%(levelname)-{level_width}s|%(message)s', datefmt='%Y-%m-%d %H:%M:%S%z')
+    formatter = logging.Formatter(fmt=LOG_FORMAT, datefmt=LOG_DATE_FORMAT)
     logger.setLevel(level)
     if console:
         handler = logging.StreamHandler(stream=sys.stdout)
         handler.setFormatter(formatter)
         logger.addHandler(handler)
     if logfile:
-        handler = logging.FileHandler(filename=logfile)
+        handler = logging.FileHandler(filename=logfile, delay=True)  # Opened on the first write
         handler.setFormatter(formatter)
-        logger.addHandler(handler)
+        # Buffer records to batch the writes, flushing immediately for warnings/errors (and at exit)
+        logger.addHandler(logging.handlers.MemoryHandler(capacity=LOG_BUFFER_CAPACITY, flushLevel=logging.WARNING, target=handler))
     return logger
 
 
@@ -458,15 +1005,19 @@ if __name__ == '__main__':
     logger = configure_logger(args.level, args.console, args.logfile)
 
     try:
-        running_instances = check_running(args.stop)
+        try:
+            running_instances = check_running(args.stop)
+        except OSError as e:  # e.g. PermissionError, or ELOOP if the pidfile is a symlink
+            sys.stderr.write(f"Unable to lock the pidfile {PID_FILE}: {e.strerror or e}\n")
+            sys.exit(1)
         if running_instances:
-            sys.stderr.write(f"At least one other instance of {script_name} is still running: {', '.join(str(proc.pid) for proc in running_instances)}")
+            sys.stderr.write(f"At least one other instance of {script_name} is still running: {', '.join(str(pid) for pid in running_instances)}")
             if not args.stop:
                 sys.stderr.write(" (try using --stop)")
             sys.stderr.write("\n")
             sys.exit(1)
 
-        logger.info(f"Monitoring: STARTED|CMD: {__file__}|ARGS: {vars(args)}|LEVEL: {logging._levelToName[args.level]}")
+        logger.info(f"Monitoring: STARTED|CMD: {__file__}|ARGS: {vars(args)}|LEVEL: {logging.getLevelName(args.level)}")
 
         interrupted = False
         if args.plot: